@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark port-templates.py on a synthetic tree of templates.
+
+A tree of templates of the requested size and shape is generated, and then
+each stage of porting it is timed on its own: building the rewrite context,
+finding the templates, each of the transforms, generating diffs, writing the
+ported templates, and finally a complete run of port-templates.py. The
+throughput of each stage is reported, and can be saved as JSON so that runs
+against different versions can be compared.
+
+Any arguments after ``--`` are passed along to port-templates.py, e.g.::
+
+    benchmark-templates.py --files 5000 -- --jobs 4 --tags-only
+
+"""
+# Note that __future__ imports must go at the top.
+from __future__ import with_statement
+
+import os
+import imp
+import sys
+import time
+import random
+import shutil
+import platform
+import tempfile
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+PORT_TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'port-templates.py')
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yml')
+
+# Building blocks for the generated templates.
+WORDS = ['story', 'photo', 'author', 'blog', 'entry', 'section', 'choice',
+         'staffmember', 'category', 'image', 'comment', 'poll', 'event', 'venue']
+FILLER = ['<div class="content">', '<p>', '</p>', '</div>', '<a href="/">',
+          '</a>', '<li>', '</li>', 'Lorem', 'ipsum', 'dolor', 'sit', 'amet,',
+          'consectetur', 'adipisicing', 'elit.', '<script>var x = 1;</script>']
+REFERENCES = [
+    '{{ object.get_%s_url }}',
+    '{{ object.get_%s_width }}',
+    '{{ object.get_%s.name }}',
+    '{{ object.get_%s_count }}',
+    '{% for item in object.get_%s_list %}',
+    '{% if object.get_%s %}',
+    '{{ object.get_absolute_url }}',
+]
+TEMPLATE_NAMES = ['base', 'base.html', 'includes/header', "includes/footer",
+                  'news/story_detail', 'widgets/sidebar.html']
+
+
+def generate_line(rng, line_length, reference_density, tag_density):
+    """Return a single line of a synthetic template."""
+    bits = []
+    if rng.random() < tag_density:
+        bits.append('{%% %s "%s" %%}' % (rng.choice(['extends', 'include']), rng.choice(TEMPLATE_NAMES)))
+
+    # reference_density is the average number of get_* references per line.
+    references = int(reference_density)
+    if rng.random() < reference_density - references:
+        references += 1
+    for i in range(references):
+        bits.append(rng.choice(REFERENCES).replace('%s', rng.choice(WORDS)))
+
+    length = sum([len(bit) + 1 for bit in bits])
+    while length < line_length:
+        bit = rng.choice(FILLER)
+        bits.insert(rng.randint(0, len(bits)), bit)
+        length += len(bit) + 1
+
+    return ' '.join(bits) + '\n'
+
+
+def generate_corpus(path, files, lines, line_length, reference_density, tag_density, seed):
+    """Write a synthetic tree of templates to the given directory."""
+    rng = random.Random(seed)
+    for i in range(files):
+        # Spread the templates over a couple of levels of directories, as
+        # they would be in a real project.
+        dirname = os.path.join(path, 'app%d' % (i % 10), 'section%d' % (i % 7))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'template%d.html' % i), 'wb') as template:
+            for j in range(lines):
+                template.write(generate_line(rng, line_length, reference_density, tag_density))
+
+
+def copy_corpus(corpus_path, scratch_path):
+    """Replace the scratch directory with a fresh copy of the corpus."""
+    if os.path.exists(scratch_path):
+        shutil.rmtree(scratch_path)
+    shutil.copytree(corpus_path, scratch_path)
+
+
+def load_port_templates(args):
+    """Import port-templates.py and give it the given command line options."""
+    port_templates = imp.load_source('port_templates', PORT_TEMPLATES_PATH)
+    port_templates.options, args = port_templates.create_parser().parse_args(args)
+    return port_templates
+
+
+def best_of(repeat, func, setup=None):
+    """Return the shortest time taken by func, and what it returned."""
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+
+def run_benchmarks(corpus_path, scratch_path, repeat, port_args):
+    """Time each stage of porting the corpus, and return the timings."""
+    port_templates = load_port_templates(['-x', '-f', '-r', '-q', '--no-model-scan',
+                                          '-c', CONFIG_PATH, '-t', scratch_path] + port_args)
+    options = port_templates.options
+    copy_corpus(corpus_path, scratch_path)
+
+    timings = []
+
+    seconds, monkey = best_of(repeat, lambda: port_templates.TemplateMonkey(options))
+    timings.append(('context', seconds))
+
+    seconds, template_paths = best_of(repeat, lambda: list(monkey.create_template_paths(None)))
+    timings.append(('discovery', seconds))
+
+    # Time the transforms on templates already in memory, so that reading
+    # them doesn't count.
+    templates = []
+    for template_path in template_paths:
+        with open(template_path, 'rb') as template:
+            templates.append((template_path, template.readlines()))
+
+    def rewrite(add_extension, update_file_fields, update_relations):
+        ported = []
+        for template_path, lines in templates:
+            ported.append([monkey.rewrite_line(line, add_extension, update_file_fields,
+                                               update_relations, options.tags_only) for line in lines])
+        return ported
+
+    # The monkey remembers the replacement for every get_* reference it
+    # has seen, so forget them before each run to time a cold start, as a
+    # real run would be.
+    def forget_decisions():
+        monkey.decisions.clear()
+
+    for name, flags in (('add_extension', (True, False, False)),
+                        ('update_file_fields', (False, True, False)),
+                        ('update_relations', (False, False, True)),
+                        ('all_transforms', (True, True, True))):
+        seconds, ported = best_of(repeat, lambda: rewrite(*flags), forget_decisions)
+        timings.append((name, seconds))
+    # The templates as ported with every transform are used from here on.
+
+    def diff():
+        for (template_path, lines), ported_lines in zip(templates, ported):
+            monkey.diff_template(template_path, lines, ported_lines)
+
+    seconds, result = best_of(repeat, diff)
+    timings.append(('diff', seconds))
+
+    def write():
+        for (template_path, lines), ported_lines in zip(templates, ported):
+            temp_path = monkey.write_template(template_path, iter(zip(lines, ported_lines)))
+            if temp_path is not None:
+                monkey.replace_template(template_path, temp_path)
+
+    seconds, result = best_of(repeat, write, lambda: copy_corpus(corpus_path, scratch_path))
+    timings.append(('write', seconds))
+
+    def port():
+        monkey.port_templates()
+
+    def setup_port():
+        copy_corpus(corpus_path, scratch_path)
+        forget_decisions()
+
+    seconds, result = best_of(repeat, port, setup_port)
+    timings.append(('port_templates', seconds))
+
+    files = len(templates)
+    size = sum([sum([len(line) for line in lines]) for template_path, lines in templates])
+    return files, size, timings
+
+
+if __name__ == '__main__':
+    usage = """%prog [options] [-- port-templates options]"""
+    desc = __doc__
+
+    parser = OptionParser(usage=usage, description=desc)
+    parser.add_option('--files',
+                                dest='files', action='store', type='int', default=1000,
+                                help=u"number of templates to generate (default to 1000)")
+    parser.add_option('--lines',
+                                dest='lines', action='store', type='int', default=100,
+                                help=u"number of lines in each template (default to 100)")
+    parser.add_option('--line-length',
+                                dest='line_length', action='store', type='int', default=80,
+                                help=u"rough length of each line (default to 80)")
+    parser.add_option('--reference-density',
+                                dest='reference_density', action='store', type='float', default=0.3,
+                                help=u"average number of get_* references per line (default to 0.3)")
+    parser.add_option('--tag-density',
+                                dest='tag_density', action='store', type='float', default=0.02,
+                                help=u"fraction of lines with an {% extends %} or {% include %} tag (default to 0.02)")
+    parser.add_option('--seed',
+                                dest='seed', action='store', type='int', default=0,
+                                help=u"seed for generating the templates (default to 0)")
+    parser.add_option('--corpus',
+                                dest='corpus_path', action='store', metavar='/path/to/templates',
+                                help=u"generate the templates here and keep them, or use the templates already here")
+    parser.add_option('--repeat',
+                                dest='repeat', action='store', type='int', default=3,
+                                help=u"time each stage this many times and keep the best (default to 3)")
+    parser.add_option('-o', '--output',
+                                dest='output_path', action='store', metavar='/path/to/results.json',
+                                help=u"save the results as JSON")
+
+    (options, args) = parser.parse_args()
+
+    work_path = tempfile.mkdtemp()
+    try:
+        corpus_path = options.corpus_path or os.path.join(work_path, 'corpus')
+        if not os.path.isdir(corpus_path) or not os.listdir(corpus_path):
+            generate_corpus(corpus_path, options.files, options.lines, options.line_length,
+                            options.reference_density, options.tag_density, options.seed)
+
+        files, size, timings = run_benchmarks(corpus_path, os.path.join(work_path, 'scratch'),
+                                              options.repeat, args)
+    finally:
+        shutil.rmtree(work_path)
+
+    megabytes = size / 1048576.0
+    print u"%d templates, %.1f MB" % (files, megabytes)
+    print u"%-20s %10s %12s %10s" % (u"stage", u"seconds", u"files/s", u"MB/s")
+    stages = []
+    for name, seconds in timings:
+        # Guard against timers too coarse to see very quick stages.
+        seconds = max(seconds, 1e-6)
+        stages.append({'stage': name, 'seconds': seconds,
+                       'files_per_second': files / seconds,
+                       'megabytes_per_second': megabytes / seconds})
+        print u"%-20s %10.3f %12.1f %10.2f" % (name, seconds, files / seconds, megabytes / seconds)
+
+    if options.output_path:
+        port_templates = sys.modules['port_templates']
+        results = {
+            'version': port_templates.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'arguments': sys.argv[1:],
+            'corpus': {'files': files, 'bytes': size, 'lines': options.lines,
+                       'line_length': options.line_length,
+                       'reference_density': options.reference_density,
+                       'tag_density': options.tag_density, 'seed': options.seed},
+            'stages': stages,
+        }
+        with open(options.output_path, 'w') as output:
+            json.dump(results, output, indent=2)
@@ -29,8 +29,24 @@ __version__ = "0.9"
 import os
 import re
 import sys
+import mmap
 import yaml
+import errno
+import shutil
 import unittest
+import cPickle as pickle
+from glob import glob
+from time import time
+from heapq import heappush, heappop
+from collections import defaultdict, deque
+from fnmatch import fnmatch
+from Queue import Queue
+from threading import Thread, Event
+from cStringIO import StringIO
+from hashlib import sha1
+from stat import S_IMODE
+from tempfile import mkstemp, mkdtemp
+from itertools import starmap
 from pprint import PrettyPrinter
 from optparse import OptionParser
 
@@ -42,78 +58,1476 @@ except (ImportError, KeyError):
     print u"Cannot find Django. Did you setup your environment correctly?"
     sys.exit()
 
+# The multiprocessing module is new in Python 2.6. Without it the --jobs
+# option is simply ignored and templates are ported one at a time.
+try:
+    from multiprocessing import Pool, cpu_count
+except ImportError:
+    Pool = None
+
+# The json module is new in Python 2.6, but Django comes with simplejson.
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
 try:
     DJANGO_SETTINGS_MODULE = os.environ['DJANGO_SETTINGS_MODULE']
 except:
     DJANGO_SETTINGS_MODULE = None
 
 
-class TemplateMonkey(object):
+def _source_digest():
+    """
+    Return a digest of this program's source.
+
+    __version__ isn't bumped for every change to how templates are ported,
+    or to what a TemplateMonkey keeps, so anything cached between runs is
+    keyed by the source itself instead.
+
+    """
+    path = os.path.abspath(__file__)
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    with open(path, 'rb') as source:
+        return sha1(source.read()).hexdigest()
+
+SOURCE_DIGEST = _source_digest()
+
+
+# The monkey each worker process ports templates with (see port_templates).
+_worker_monkey = None
+
+def _init_worker(monkey):
+    """Receive the rewrite state once, when a worker process starts."""
+    global _worker_monkey
+    _worker_monkey = monkey
+
+def _port_template(task):
+    """Port a single template in a worker process."""
+    return _worker_monkey.port_template(*task)
+
+
+class PortError(Exception):
+    """A problem that stops a TemplateMonkey before (or from) porting anything."""
+
+
+class PortStats(object):
+    """
+    Timings and counts gathered while porting templates (see --stats).
+
+    Timings are in seconds, and are totals across all worker processes
+    rather than wall-clock time. Each template is measured with its own
+    PortStats, which is sent back from the worker process (if any) and
+    merged into the PortStats for the whole run.
+
+    ``references`` is all the time spent on get_* references, whereas
+    ``decide_file_fields`` and ``decide_relations`` are only the time spent
+    working out the replacements for references not seen before (see
+    rewrite_reference).
+
+    """
 
     def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.slowest = []
+
+
+    def merge(self, other):
+        for name, seconds in other.timings.items():
+            self.timings[name] += seconds
+        for name, count in other.counters.items():
+            self.counters[name] += count
+
+
+    def add_template(self, template_path, seconds, limit):
+        """Remember the template if it is among the ``limit`` slowest."""
+        heappush(self.slowest, (seconds, template_path))
+        if len(self.slowest) > limit:
+            heappop(self.slowest)
+
 
+    def as_dict(self):
+        slowest = sorted(self.slowest, reverse=True)
+        return {
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+            'slowest': [{'template_path': path, 'seconds': seconds} for seconds, path in slowest],
+        }
+
+
+    def report(self, stream):
+        print >> stream, u"Time spent (seconds):"
+        for name in ('load_config', 'model_scan', 'discovery', 'rewrite', 'add_extension',
+                     'references', 'decide_file_fields', 'decide_relations', 'diff', 'io'):
+            print >> stream, u"  %-20s %10.3f" % (name, self.timings[name])
+        print >> stream, u"Counts:"
+        for name in ('templates', 'prefiltered', 'linked', 'lines', 'matches', 'substitutions',
+                     'decision_cache_hits', 'ignored_methods_hits', 'related_names_hits'):
+            print >> stream, u"  %-20s %10d" % (name, self.counters[name])
+        if self.slowest:
+            print >> stream, u"Slowest templates (seconds):"
+            for seconds, template_path in sorted(self.slowest, reverse=True):
+                print >> stream, u"  %10.3f  %s" % (seconds, template_path)
+
+
+class IOJob(object):
+    """A function to be run by one of the IOThreads, which can be waited on."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.event = Event()
+        self.value = self.exc_info = None
+
+
+    def finished(cls, value):
+        """Return a job that is already done, with the given value."""
+        job = cls(None, ())
+        job.value = value
+        job.event.set()
+        return job
+    finished = classmethod(finished)
+
+
+    def run(self):
         try:
-            self.settings = __import__(options.settings)
-            os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
-        except ImportError:
-            print u"Cannot load settings module."
-            sys.exit()
+            self.value = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.event.set()
+
+
+    def done(self):
+        return self.event.isSet()
+
+
+    def wait(self):
+        """Return the value of the function once it is done, or raise what it raised."""
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class IOThreads(object):
+    """
+    A fixed number of threads for reading and writing files (see --io-threads).
+
+    Jobs wait in a bounded queue, so whoever hands them out can't get
+    too far ahead of the threads.
+
+    """
+
+    def __init__(self, count):
+        self.jobs = Queue(count * 2)
+        self.threads = []
+        for i in range(count):
+            thread = Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job.run()
+
 
+    def run(self, func, *args):
+        """Have one of the threads run func(*args), and return the IOJob to wait on."""
+        job = IOJob(func, args)
+        self.jobs.put(job)
+        return job
+
+
+    def close(self):
+        """Let the threads finish the jobs already handed out, and then stop."""
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class TemplateMonkey(object):
+
+    # The most get_* references to remember the replacements of. Real
+    # templates use a few thousand distinct references at most, so this
+    # only guards against pathological input.
+    decision_cache_size = 50000
+
+    def __init__(self, options=None, **kwargs):
+        """
+        Load everything needed to port templates.
+
+        ``options`` are the command line options (see create_options), or
+        any options may be given as keyword arguments instead.
+
+        """
+        if options is None:
+            options = create_options(**kwargs)
+        self.options = options
+        self.settings = None
         self.printer = PrettyPrinter(indent=2)
+
+        if self.options.stats or self.options.stats_path or self.options.verbosity:
+            self.stats = PortStats()
+        else:
+            self.stats = None
+
+        # The replacement for every distinct get_* reference is worked out
+        # once and then remembered for the rest of the run (see
+        # rewrite_reference). Each worker process starts with its own copy.
+        self.decisions = {}
+        if self.options.decisions_path:
+            self.decision_counts = defaultdict(int)
+        else:
+            self.decision_counts = None
+
+        # The {% extends %} and {% include %} tags found while adding
+        # extensions, as (tag, template name) pairs (see --dependencies).
+        if self.options.dependencies_path:
+            self.dependencies = []
+        else:
+            self.dependencies = None
+
+        # Building the rewrite context means parsing the config and walking
+        # every installed model, so reuse the one from the last run if we can.
+        if not self.load_context():
+            # Without a model scan, the context would be missing the models'
+            # methods, and would replace a good one for everyone sharing it.
+            if self.options.context_path and self.options.no_model_scan:
+                raise PortError(u"The --context file is missing or out of date (e.g. config.yml or this program has changed), and cannot be rebuilt with --no-model-scan. Run once without --no-model-scan to rebuild it.")
+            self.build_context()
+            if self.options.context_path:
+                self.save_context()
+
+        # The templates are only looked for once they are needed (see
+        # port_templates).
+        self.template_paths = None
+        self.template_roots = []
+        self.output_roots = None
+        # Files that couldn't be put in the --output directory.
+        self.mirror_errors = []
+
+
+    def load_settings(self):
+        """Import the settings module, if that hasn't been done already."""
+        if self.settings is None:
+            try:
+                self.settings = __import__(self.options.settings)
+                os.environ['DJANGO_SETTINGS_MODULE'] = self.options.settings
+            except ImportError:
+                raise PortError(u"Cannot load settings module.")
+        return self.settings
+
+
+    def build_context(self):
+        """
+        Build the rewrite context from the config and installed models.
+
+        The rewrite context is everything needed to port a template: the
+        extensions, related_names and ignored_methods tables, and the
+        compiled regexen.
+
+        """
         config = self.load_config()
         self.extensions = config['extensions']
-        self.related_names = config['related_names'] + ["%s_count" % rn for rn in config['related_names']] + ["%s_list" % rn for rn in config['related_names']]
+        self.related_names = self.build_related_names(config['related_names'])
         self.ignored_methods = config['ignored_methods']
-        self.template_paths = config['template_paths']
+        self.config_paths = config['template_paths']
+
+        # Template references that already end with one of these are skipped.
+        self.extension_suffixes = tuple(['.%s' % ext for ext in config['extensions']])
 
         # Compile the regexen here for speed.
-        self.extension_regex = re.compile(r'{%\s+?(?P<tag>extends|include)\s+?(\"|\')(?P<file_path>.*?)(\"|\')\s+?%}')
-        self.extension_present_regex = re.compile(r'{%\s+?(?P<tag>extends|include)\s+?(\"|\')(?P<file_path>.*?)\.(' + '|'.join(config['extensions']) + r')(\"|\')\s+?%}')
+        # The rewrite regex finds every {% extends %}/{% include %} tag and
+        # every get_* reference in a single scan of the line. The regexen
+        # below it are then only ever run on one reference at a time.
+        self.rewrite_regex = re.compile(r'(?P<tag_match>{%\s+?(?P<tag>extends|include)\s+?(\"|\')(?P<file_path>.*?)(\"|\')\s+?%})|(?P<prepend_char>\.|\"|\')(?P<reference>get_[A-Za-z0-9_]*)')
+        self.tag_regex = re.compile(r'(%s.*?%s|%s.*?%s|%s.*?%s)' % (re.escape(BLOCK_TAG_START), re.escape(BLOCK_TAG_END),
+                                                                  re.escape(VARIABLE_TAG_START), re.escape(VARIABLE_TAG_END),
+                                                                  re.escape(COMMENT_TAG_START), re.escape(COMMENT_TAG_END)))
         self.file_field_regex = re.compile(r'(?P<prepend_char>\.|\"|\')(?P<full_match>get_(?P<field>[A-Za-z0-9_]*?)_(?P<method>url|size|file|width|height|filename))')
+        self.file_method_regex = re.compile(r'get_[A-Za-z0-9_]*?_(url|size|file|width|height|filename)$')
         self.rel_basic_regex = re.compile(r'(?P<prepend_char>\.|\"|\')(?P<full_match>get_(?P<field>[A-Za-z0-9_]*?))(?P<following_char>\s|\.)')
         self.rel_count_regex = re.compile(r'(?P<prepend_char>\.|\"|\')(?P<full_match>get_(?P<field>[A-Za-z0-9_]*?)_count)')
         self.rel_list_regex = re.compile(r'(?P<prepend_char>\.|\"|\')(?P<full_match>get_(?P<field>[A-Za-z0-9_]*?)_list)')
 
 
+    def build_related_names(self, config_related_names):
+        """
+        Map get_foo_list and get_foo_count methods to their replacements.
+
+        Each config.related_names entry maps a method (such as
+        ``get_staffmember``) to a related_name (such as ``bylines``), giving::
+
+            get_staffmember_list   =>  bylines.all
+            get_staffmember_count  =>  bylines.count
+
+        Building every form up front means each reference needs just one
+        dictionary lookup. Bare get_foo methods are not relations to many
+        objects, so they are left to the usual rules.
+
+        """
+        related_names = {}
+        # YAML gives us a list of single-item dictionaries, but a plain
+        # mapping is fine too.
+        if isinstance(config_related_names, dict):
+            config_related_names = [config_related_names]
+        for mapping in config_related_names or []:
+            for method, related_name in mapping.items():
+                related_names['%s_list' % method] = '%s.all' % related_name
+                related_names['%s_count' % method] = '%s.count' % related_name
+        return related_names
+
+
+    def load_context(self):
+        """
+        Load the rewrite context cached by --context, if it is still good.
+
+        A cached context is only used if it was built from an identical
+        config file, and (unless --no-model-scan was given) with the same
+        Django version and the same installed apps' models modules. With
+        --no-model-scan a context built elsewhere, with a full model scan,
+        can therefore be used without importing any models at all.
+
+        Returns True if the context was loaded.
+
+        """
+        if not self.options.context_path:
+            return False
+
+        # A context that can't be read for any reason, e.g. one written by
+        # another version of this program, is simply rebuilt.
+        try:
+            with open(self.options.context_path, 'rb') as context_file:
+                context = pickle.load(context_file)
+            if context.get('config_key') != self.config_key():
+                return False
+            state = context['state']
+        except Exception:
+            return False
+
+        if not self.options.no_model_scan and context.get('model_signature') != self.model_signature():
+            return False
+
+        self.__dict__.update(state)
+        return True
+
+
+    def save_context(self):
+        """Cache the rewrite context for the next run."""
+        context = {
+            'config_key': self.config_key(),
+            'model_signature': None if self.options.no_model_scan else self.model_signature(),
+            'state': self.__getstate__(),
+        }
+        for attr in ('options', 'template_roots', 'output_roots', 'mirror_errors', 'stats', 'decisions', 'decision_counts', 'dependencies'):
+            context['state'].pop(attr, None)
+        self.save_pickle(context, self.options.context_path)
+
+
+    def config_key(self):
+        """Return a digest of the config file (and this program's source)."""
+        return sha1(SOURCE_DIGEST + self.file_digest(self.options.config_path)).hexdigest()
+
+
+    def model_signature(self):
+        """
+        Return a cheap signature of the models that load_config scans.
+
+        Rather than importing every model, this notes the Django version,
+        the installed apps and the size and modification time of each app's
+        models module (or package).
+
+        """
+        import django
+        settings = self.load_settings()
+        signature = [django.get_version()]
+
+        for app in settings.INSTALLED_APPS:
+            try:
+                __import__(app)
+                app_path = os.path.dirname(sys.modules[app].__file__)
+            except (ImportError, AttributeError):
+                signature.append((app, None))
+                continue
+            models_path = os.path.join(app_path, 'models')
+            for path in [models_path + '.py'] + sorted(glob(os.path.join(models_path, '*.py'))):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature.append((path, stat.st_size, stat.st_mtime))
+
+        return signature
+
+
+    def __getstate__(self):
+        """
+        Return only what is needed to port templates.
+
+        The settings module cannot be pickled, and worker processes have
+        no use for it (or the list of templates) anyway.
+
+        """
+        state = self.__dict__.copy()
+        for attr in ('settings', 'printer', 'template_paths'):
+            state.pop(attr, None)
+        # Workers gather their own stats, if any.
+        if self.stats is not None:
+            state['stats'] = PortStats()
+        if self.decision_counts is not None:
+            state['decision_counts'] = defaultdict(int)
+        return state
+
+
     def port_templates(self):
         """Run requested methods on the specified templates."""
 
-        if not options.add_extension and \
-           not options.update_file_fields and \
-           not options.update_relations:
-            print u"This monkey won’t do anything unless you tell it to — see available options by running “port-templates.py --help”"
-            sys.exit()
+        if not self.options.add_extension and \
+           not self.options.update_file_fields and \
+           not self.options.update_relations:
+            raise PortError(u"This monkey won’t do anything unless you tell it to — see available options by running “port-templates.py --help”")
+
+        if self.options.dependencies_path and not self.options.add_extension:
+            raise PortError(u"The {% extends %} and {% include %} tags are found while adding extensions, so --dependencies needs the --add-extension option too.")
+
+        # Look for the templates afresh on every call, as the directories
+        # may well have changed since the last one.
+        self.template_paths = self.create_template_paths(self.config_paths)
+        self.mirror_errors = []
+
+        if self.options.output_path:
+            self.output_roots = self.mirror_template_roots(self.options.output_path)
+
+        # Templates that have not changed since the last incremental run
+        # are never even opened, let alone sent to a worker.
+        unchanged = []
+        if self.options.incremental:
+            manifest = self.load_manifest()
+            # Skipped templates keep their entries from the last dependency
+            # index, so without one every template has to be read again.
+            if self.options.dependencies_path and not os.path.exists(self.options.dependencies_path):
+                manifest['templates'] = {}
+            tasks = self.incremental_tasks(manifest, unchanged)
+        else:
+            manifest = None
+            tasks = ((template_path, None) for template_path in self.template_paths)
+
+        jobs = self.options.jobs
+        if Pool is not None and jobs == 0:
+            jobs = cpu_count()
+
+        if Pool is not None and jobs > 1:
+            # Each worker gets the compiled regexen and the ignored_methods
+            # and related_names tables once, when it starts. imap hands the
+            # results back in the same order as the templates went out, so
+            # the output is just what a serial run would print.
+            pool = Pool(jobs, _init_worker, (self,))
+            results = pool.imap(_port_template, tasks, 16)
+        elif self.options.io_threads > 0:
+            pool = None
+            results = self.port_templates_threaded(tasks)
+        else:
+            pool = None
+            results = starmap(self.port_template, tasks)
+
+        # Dry runs write one patch of every change, in a form that either
+        # “git apply” or “patch -p1” will accept.
+        patch_file = None
+        if self.options.dry_run:
+            if self.options.patch_path:
+                patch_file = open(self.options.patch_path, 'wb')
+            else:
+                patch_file = sys.stdout
+
+        changed = 0
+        untouched = 0
+        errors = []
+        dependencies = {}
+        try:
+            for result in results:
+                if result['decisions'] is not None:
+                    for decision, count in result['decisions'].items():
+                        self.decision_counts[decision] += count
+                if result['stats'] is not None:
+                    self.stats.merge(result['stats'])
+                    self.stats.add_template(result['template_path'], result['seconds'], self.options.slowest)
+                if result['error']:
+                    errors.append(result)
+                    continue
+                if result['manifest_entry'] is not None:
+                    manifest['templates'][os.path.abspath(result['template_path'])] = result['manifest_entry']
+                if result['unchanged']:
+                    unchanged.append(result['template_path'])
+                    continue
+                if result['dependencies'] is not None:
+                    # Django uses the first template of any given name.
+                    name = self.template_name(result['template_path'])
+                    if name not in dependencies:
+                        dependencies[name] = self.dependency_entry(result['template_path'], result['dependencies'])
+                if result['changed']:
+                    changed += 1
+                    if self.options.verbosity:
+                        print >> sys.stderr, u"Changed %s" % result['template_path']
+                else:
+                    untouched += 1
+                if result['diff'] is not None:
+                    patch_file.write(result['diff'])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if patch_file is not None and patch_file is not sys.stdout:
+                patch_file.close()
+
+        # Templates are found as they are ported, so only now is it known
+        # whether there were any at all.
+        if not changed and not untouched and not unchanged and not errors:
+            raise PortError(u"No templates were found in %s. Note that only files ending with one of config.extensions are ported, unless --include is given." % u", ".join(self.template_roots))
+
+        if manifest is not None and not self.options.dry_run:
+            self.save_manifest(manifest)
+
+        if self.options.verbosity is not False:
+            print >> sys.stderr, u"Ported %d templates: %d changed, %d untouched." % (changed + untouched, changed, untouched)
+            if self.options.incremental:
+                print >> sys.stderr, u"Skipped %d templates unchanged since the last run." % len(unchanged)
+            for result in errors:
+                print >> sys.stderr, u"Could not port %s: %s" % (result['template_path'], result['error'])
+            for path, error in self.mirror_errors:
+                print >> sys.stderr, u"Could not copy %s: %s" % (path, error)
+
+        if self.stats is not None:
+            if self.options.stats or self.options.verbosity:
+                self.stats.report(sys.stderr)
+            if self.options.stats_path:
+                with open(self.options.stats_path, 'w') as stats_file:
+                    json.dump(self.stats.as_dict(), stats_file, indent=2)
+
+        if self.decision_counts is not None:
+            self.save_decisions(self.options.decisions_path)
+
+        if self.dependencies is not None:
+            self.save_dependencies(dependencies, unchanged)
+
+
+    def save_decisions(self, decisions_path):
+        """
+        Write out every distinct get_* reference found, and what it became.
+
+        Each line gives a reference, its replacement (or “-” if it was left
+        alone) and the number of times it was found, separated by tabs and
+        sorted by reference. A reference may appear more than once if it
+        was replaced differently in different places.
+
+        """
+        with open(decisions_path, 'w') as decisions_file:
+            for (reference, replacement), count in sorted(self.decision_counts.items()):
+                if replacement == reference:
+                    replacement = '-'
+                decisions_file.write('%s\t%s\t%d\n' % (reference, replacement, count))
+
+
+    def port_string(self, template):
+        """
+        Return the ported version of a template given as a string.
+
+        This makes the same changes port_templates would make to a template
+        with the same contents, and works just as well on unicode strings.
+
+        Nothing is gathered for --decisions or --dependencies, as nothing
+        would ever save it.
+
+        """
+        collectors = self.decision_counts, self.dependencies
+        self.decision_counts = self.dependencies = None
+        try:
+            lines = template.splitlines(True)
+            return ''.join([ported_line for line, ported_line in self.rewrite_lines(lines)])
+        finally:
+            self.decision_counts, self.dependencies = collectors
+
+
+    def port_strings(self, templates):
+        """Generate the ported version of each of the given template strings."""
+        for template in templates:
+            yield self.port_string(template)
+
+
+    def port_files(self, template_paths):
+        """
+        Port each of the given templates, and generate the results.
+
+        This is just what port_templates does, without looking for
+        templates, saving a manifest or reporting on the results. See
+        port_template for the results.
+
+        """
+        for template_path in template_paths:
+            yield self.port_template(template_path)
+
+
+    def handle_request(self, request):
+        """
+        Answer a single request to the server (see serve).
+
+        A request with a ``template`` string is answered with the ported
+        ``template``. A request with a template ``path`` has that template
+        ported, and is answered with whether it ``changed``, its ``diff``
+        (in a dry run) and any ``error``. Either is answered with an
+        ``error`` if something goes wrong. Any ``id`` given with the
+        request is sent back with the response.
+
+        """
+        response = {}
+        if 'id' in request:
+            response['id'] = request['id']
+
+        if isinstance(request.get('template'), basestring):
+            response['template'] = self.port_string(request['template'])
+        elif isinstance(request.get('path'), basestring):
+            result = self.port_template(request['path'])
+            response['path'] = result['template_path']
+            response['changed'] = result['changed']
+            response['diff'] = result['diff']
+            response['error'] = result['error']
+        else:
+            response['error'] = u"Requests need a template or a path."
+        return response
+
+
+    def serve(self, requests, responses):
+        """
+        Answer requests to port templates until there are no more.
+
+        Each request is a JSON object on a line of its own, read from the
+        ``requests`` file, and is answered with a JSON object on a line of
+        its own, written to the ``responses`` file. See handle_request.
+
+        As the rewrite context is loaded just once, when the server
+        starts, each request takes about as long as the porting itself.
+
+        """
+        for line in iter(requests.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError(u"Requests must be JSON objects.")
+                response = json.dumps(self.handle_request(request))
+            except ValueError, e:
+                response = json.dumps({'error': unicode(e)})
+            except Exception, e:
+                # Keep serving, whatever went wrong with this request.
+                response = json.dumps({'error': repr(e)})
+            responses.write(response + '\n')
+            responses.flush()
+
+
+    def serve_socket(self, socket_path):
+        """
+        Answer requests from connections to a Unix socket (see serve).
+
+        Connections are handled one at a time, and each may send any number
+        of requests. The socket is removed when the server stops.
+
+        """
+        from SocketServer import UnixStreamServer, StreamRequestHandler
+
+        monkey = self
+
+        class RequestHandler(StreamRequestHandler):
+            def handle(self):
+                monkey.serve(self.rfile, self.wfile)
+
+        # Clear away the socket of a server that didn't stop cleanly.
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixStreamServer(socket_path, RequestHandler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+
+    def port_templates_threaded(self, tasks):
+        """
+        Port templates while reading and writing them in other threads.
+
+        Porting is still done one template at a time, in this thread, but
+        the templates are read ahead of time by --io-threads I/O threads,
+        and written once ported by the same threads. This keeps this
+        thread busy when opening, reading or writing files is slow (e.g. on
+        a network filesystem) and the process would otherwise sit idle.
+
+        No more than a few templates per I/O thread are held in memory at
+        once: once that many have been read or are waiting to be written,
+        no more are read until the oldest has been written.
+
+        Generates the results in the same order as ``tasks``, just like
+        port_template would.
+
+        """
+        io_threads = IOThreads(self.options.io_threads)
+        limit = self.options.io_threads * 4
+        reads = deque()
+        writes = deque()
+        tasks = iter(tasks)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(reads) + len(writes) < limit:
+                    try:
+                        template_path, previous = tasks.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    reads.append((template_path, previous, io_threads.run(self.read_template, template_path)))
+
+                # Hand back whatever has already been written, in order.
+                while writes and writes[0].done():
+                    yield writes.popleft().wait()
+
+                if reads:
+                    template_path, previous, read = reads.popleft()
+                    result = self.port_template(template_path, previous, read.wait())
+                    if result['pairs'] is not None:
+                        writes.append(io_threads.run(self.save_template, result, template_path, result['pairs']))
+                    else:
+                        writes.append(IOJob.finished(result))
+                elif writes:
+                    yield writes.popleft().wait()
+                elif exhausted:
+                    break
+        finally:
+            io_threads.close()
+
+
+    def read_template(self, template_path):
+        """Return the contents of a template, or None if it can't be read (to be reported later)."""
+        try:
+            with open(template_path, 'rb') as template:
+                return template.read()
+        except (IOError, OSError):
+            return None
+
+
+    def template_name(self, template_path):
+        """Return the name Django knows a template by, i.e. its path within its template root."""
+        path = os.path.abspath(template_path)
+        for template_root in self.template_roots:
+            template_root = os.path.join(os.path.abspath(template_root), '')
+            if path.startswith(template_root):
+                return path[len(template_root):].replace(os.sep, '/')
+        # The template was given on its own, rather than as part of a root.
+        return os.path.basename(path)
+
+
+    def dependency_entry(self, template_path, dependencies):
+        """Return the dependency index entry for a template and the tags found in it."""
+        entry = {'path': os.path.abspath(template_path), 'extends': [], 'includes': []}
+        for tag, name in dependencies:
+            names = entry[tag == 'extends' and 'extends' or 'includes']
+            if name not in names:
+                names.append(name)
+        return entry
+
+
+    def save_dependencies(self, dependencies, unchanged):
+        """
+        Write out the index of which templates extend or include which.
+
+        The index is a JSON object. Its ``templates`` map the name of each
+        template to its path and the names of the templates it extends and
+        includes. Its ``missing`` map the name of each extended or included
+        template that can't be found under any of the template roots to
+        the templates that refer to it.
+
+        Templates that weren't read this time (see --incremental) keep
+        their entries from the last index.
+
+        """
+        if unchanged:
+            try:
+                with open(self.options.dependencies_path, 'rb') as index_file:
+                    previous = json.load(index_file)['templates']
+            except (IOError, ValueError, KeyError):
+                previous = {}
+            names = dict([(entry['path'], name) for name, entry in previous.items()])
+            for template_path in unchanged:
+                name = names.get(os.path.abspath(template_path))
+                if name is not None and name not in dependencies:
+                    dependencies[name] = previous[name]
+
+        missing = defaultdict(list)
+        for name, entry in sorted(dependencies.items()):
+            for dependency in entry['extends'] + entry['includes']:
+                if dependency not in dependencies and not self.template_exists(dependency):
+                    missing[dependency].append(name)
+
+        index = {
+            'template_roots': [os.path.abspath(template_root) for template_root in self.template_roots],
+            'templates': dependencies,
+            'missing': missing,
+        }
+        with open(self.options.dependencies_path, 'w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+
+
+    def template_exists(self, name):
+        """Return whether a template of the given name is in any of the template roots."""
+        for template_root in self.template_roots:
+            if os.path.isdir(template_root) and os.path.isfile(os.path.join(template_root, name)):
+                return True
+        return False
+
+
+    def port_template(self, template_path, previous=None, contents=None):
+        """
+        Port a single template.
+
+        ``previous`` is the template's manifest entry from the last
+        incremental run, if any. The template is left alone if its contents
+        still match that entry.
+
+        If the ``contents`` of the template are given, the template is not
+        read, and the ported lines are returned as the result's ``pairs``
+        rather than written (unless this is a dry run). See
+        port_templates_threaded.
+
+        Returns a dictionary describing the outcome, which is all that is
+        sent back from worker processes.
+
+        """
+        if self.stats is None and self.decision_counts is None and self.dependencies is None:
+            return self._port_template_file(template_path, previous, contents)
+
+        # Gather this template's stats, decisions and dependencies on their own.
+        run_stats, run_decision_counts, run_dependencies = self.stats, self.decision_counts, self.dependencies
+        if run_stats is not None:
+            self.stats = PortStats()
+        if run_decision_counts is not None:
+            self.decision_counts = defaultdict(int)
+        if run_dependencies is not None:
+            self.dependencies = []
+        start = time()
+        try:
+            result = self._port_template_file(template_path, previous, contents)
+        finally:
+            template_stats, self.stats = self.stats, run_stats
+            template_decision_counts, self.decision_counts = self.decision_counts, run_decision_counts
+            template_dependencies, self.dependencies = self.dependencies, run_dependencies
+
+        if template_decision_counts is not None:
+            result['decisions'] = dict(template_decision_counts)
+        result['dependencies'] = template_dependencies
+        if template_stats is None:
+            return result
+
+        # Whatever time wasn't spent rewriting or diffing went on reading,
+        # hashing and writing.
+        result['seconds'] = time() - start
+        template_stats.timings['io'] += result['seconds'] - template_stats.timings['rewrite'] - template_stats.timings['diff']
+        template_stats.counters['templates'] += 1
+        result['stats'] = template_stats
+        return result
+
+
+    def _port_template_file(self, template_path, previous, contents):
+        result = {'template_path': template_path, 'diff': None, 'error': None,
+                  'changed': False, 'unchanged': False, 'manifest_entry': None,
+                  'stats': None, 'decisions': None, 'dependencies': None,
+                  'seconds': None, 'pairs': None}
+
+        try:
+            # The file was touched since the last run, but may well have the
+            # same contents.
+            if previous is not None:
+                digest = self.contents_digest(template_path, contents)
+                if digest == previous[2]:
+                    result['unchanged'] = True
+                    result['manifest_entry'] = self.manifest_entry(template_path, digest)
+                    return result
+
+            # Most templates have nothing to port at all, which a quick scan
+            # of the whole file can tell without any regex work.
+            transforms = self.classify_template(template_path, contents)
+            if not transforms:
+                if self.stats is not None:
+                    self.stats.counters['prefiltered'] += 1
+                if self.options.output_path and not self.options.dry_run:
+                    self.link_template(template_path)
+                if self.options.incremental and not self.options.dry_run:
+                    if previous is None:
+                        digest = self.contents_digest(template_path, contents)
+                    result['manifest_entry'] = self.manifest_entry(template_path, digest)
+                return result
+
+            # The template has already been read by an I/O thread (see
+            # port_templates_threaded), and is written by one too.
+            if contents is not None:
+                pairs = self.rewrite_lines(StringIO(contents), *transforms)
+                if self.options.dry_run:
+                    self.diff_pairs(result, template_path, pairs)
+                else:
+                    result['pairs'] = list(pairs)
+                return result
 
-        for template_path in self.template_paths:
             # Using “with” statements with file objcts is good practice, per
             # http://docs.python.org/tutorial/inputoutput.html
             # Note that “with” statements have to be enabled in Python 2.5. See
             # http://docs.python.org/whatsnew/2.5.html#pep-343-the-with-statement
-            with open(template_path, 'r+') as template:
-                # Stow the original.
-                original_template = template
-                ported_template = ''
-
-                for line in template:
-                    # Now call each method on every line of the template, as needed.
-                    if options.add_extension:
-                        line = self.add_extension(line)
-                    if options.update_file_fields:
-                        line = self.update_file_fields(line)
-                    if options.update_relations:
-                        line = self.update_relations(line)
-
-                    ported_template += line
-
-                if not options.dry_run:
-                    ported_template_file = open(template_path, 'w')
-                    ported_template_file.write(ported_template)
-                    ported_template_file.close()
+            with open(template_path, 'rb') as template:
+                # Lines are read, ported and written one at a time, so only
+                # a line or so of any template is ever held in memory.
+                pairs = self.rewrite_lines(template, *transforms)
+
+                if not self.options.dry_run:
+                    digest = sha1() if self.options.incremental else None
+                    temp_path = self.write_template(template_path, pairs, digest)
                 else:
-                    from difflib import unified_diff
-                    print u"Diff for ‘%s’" % template_path
-                    print u"".join(unified_diff(original_template, ported_template))
-                    print
+                    self.diff_pairs(result, template_path, pairs)
+
+            if not self.options.dry_run:
+                self.finish_template(result, template_path, temp_path, digest)
+        except (IOError, OSError), e:
+            result['error'] = e.strerror or str(e)
+
+        return result
+
+
+    def save_template(self, result, template_path, pairs):
+        """Write out the ported lines of a template that was read by an I/O thread."""
+        try:
+            digest = sha1() if self.options.incremental else None
+            temp_path = self.write_template(template_path, pairs, digest, in_memory=True)
+            self.finish_template(result, template_path, temp_path, digest)
+        except (IOError, OSError), e:
+            result['error'] = e.strerror or str(e)
+        result['pairs'] = None
+        return result
+
+
+    def finish_template(self, result, template_path, temp_path, digest):
+        # Leave the file (and its mtime) alone unless something actually
+        # changed.
+        if temp_path is not None:
+            result['changed'] = True
+            self.replace_template(template_path, temp_path)
+        elif self.options.output_path:
+            self.link_template(template_path)
+        if self.options.incremental:
+            result['manifest_entry'] = self.manifest_entry(template_path, digest.hexdigest())
+
+
+    def diff_pairs(self, result, template_path, pairs):
+        original_template = []
+        ported_template = []
+        for line, ported_line in pairs:
+            original_template.append(line)
+            ported_template.append(ported_line)
+        start = time()
+        result['diff'] = self.diff_template(template_path, original_template, ported_template)
+        result['changed'] = result['diff'] is not None
+        if self.stats is not None:
+            self.stats.timings['diff'] += time() - start
+
+
+    def diff_template(self, template_path, original_template, ported_template, context=3):
+        """
+        Return a unified diff of a template's lines and its ported lines.
+
+        Porting never adds or removes lines, so each ported line stands in
+        for the original line at the same position. That means the changed
+        lines can be found by simply comparing the two lists, rather than
+        with difflib's much slower sequence matching. Consecutive changed
+        lines are shown as all removals and then all additions, just as
+        diff would show them.
+
+        Paths are given relative to the current directory, with the usual
+        ``a/`` and ``b/`` prefixes. Returns None if no line changed.
+
+        """
+        changed_lines = [i for i in xrange(len(original_template))
+                         if original_template[i] != ported_template[i]]
+        if not changed_lines:
+            return None
+
+        # Group the changed lines into hunks, which overlap if the changes
+        # are close enough for their context lines to meet.
+        hunks = []
+        first = last = changed_lines[0]
+        for i in changed_lines[1:]:
+            if i - last > 2 * context:
+                hunks.append((first, last))
+                first = i
+            last = i
+        hunks.append((first, last))
+
+        path = self.patch_path(template_path)
+        diff = ['--- a/%s\n' % path, '+++ b/%s\n' % path]
+
+        for first, last in hunks:
+            start = max(0, first - context)
+            end = min(len(original_template), last + context + 1)
+            if end - start == 1:
+                lines = '%d' % (start + 1)
+            else:
+                lines = '%d,%d' % (start + 1, end - start)
+            diff.append('@@ -%s +%s @@\n' % (lines, lines))
+
+            i = start
+            while i < end:
+                if original_template[i] == ported_template[i]:
+                    diff.append(self._diff_line(' ', original_template[i]))
+                    i += 1
+                    continue
+                j = i
+                while j < end and original_template[j] != ported_template[j]:
+                    j += 1
+                for line in original_template[i:j]:
+                    diff.append(self._diff_line('-', line))
+                for line in ported_template[i:j]:
+                    diff.append(self._diff_line('+', line))
+                i = j
+
+        return ''.join(diff)
+
+
+    def _diff_line(self, prefix, line):
+        if line.endswith('\n'):
+            return prefix + line
+        return '%s%s\n\\ No newline at end of file\n' % (prefix, line)
+
+
+    def patch_path(self, template_path):
+        """Return a template's path relative to the current directory, if it is within it."""
+        path = os.path.abspath(template_path)
+        cwd = os.path.join(os.getcwd(), '')
+        if path.startswith(cwd):
+            path = path[len(cwd):]
+        return path.lstrip(os.sep).replace(os.sep, '/')
+
+
+    def classify_template(self, template_path, contents=None):
+        """
+        Return the transforms that could possibly change a template.
+
+        The raw contents of the template are scanned (without reading the
+        file into memory) for the literal strings that every change starts
+        from: “extends” or “include” for add_extension, and “get_” for
+        update_file_fields and update_relations. Returns an
+        (add_extension, update_file_fields, update_relations) tuple of the
+        requested transforms that found something to work on, or an empty
+        tuple if there is nothing to do.
+
+        The ``contents`` of the template may be given if they have already
+        been read.
+
+        """
+        if contents is None:
+            with open(template_path, 'rb') as template:
+                try:
+                    contents = mmap.mmap(template.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty files cannot be mapped, and have nothing to port.
+                    return ()
+                try:
+                    return self.classify_template(template_path, contents)
+                finally:
+                    contents.close()
+
+        add_extension = self.options.add_extension and (contents.find('extends') != -1 or
+                                                   contents.find('include') != -1)
+        update_references = (self.options.update_file_fields or self.options.update_relations) and \
+                            contents.find('get_') != -1
+
+        if not add_extension and not update_references:
+            return ()
+        return (add_extension,
+                update_references and self.options.update_file_fields,
+                update_references and self.options.update_relations)
+
+
+    def rewrite_lines(self, lines, add_extension=None, update_file_fields=None, update_relations=None):
+        """
+        Generate (line, ported_line) pairs for each of the given lines.
+
+        The transforms default to those given on the command line. Lines
+        without the strings that any of the transforms start from (see
+        classify_template) are passed through untouched.
+
+        """
+        if add_extension is None:
+            add_extension = self.options.add_extension
+        if update_file_fields is None:
+            update_file_fields = self.options.update_file_fields
+        if update_relations is None:
+            update_relations = self.options.update_relations
+        update_references = update_file_fields or update_relations
+
+        stats = self.stats
+        for line in lines:
+            if stats is not None:
+                start = time()
+            if (update_references and 'get_' in line) or \
+               (add_extension and ('extends' in line or 'include' in line)):
+                # Apply every requested change to the line in one go.
+                ported_line = self.rewrite_line(line,
+                                                add_extension,
+                                                update_file_fields,
+                                                update_relations,
+                                                self.options.tags_only)
+            else:
+                ported_line = line
+            if stats is not None:
+                stats.timings['rewrite'] += time() - start
+                stats.counters['lines'] += 1
+            yield line, ported_line
+
+
+    def write_template(self, template_path, pairs, digest=None, in_memory=False):
+        """
+        Stream the ported version of a template into a temporary file.
+
+        ``pairs`` are (line, ported_line) pairs from rewrite_lines. Nothing
+        is written until the first line that actually changes, at which
+        point a temporary file is created in the directory the ported
+        template goes in (see destination) and the untouched lines before
+        it are copied straight across from the template (or, if
+        ``in_memory`` is true, from the pairs themselves, which are then
+        already held in memory and spare the template being read again).
+        ``digest``, if
+        given, is updated with every line of the template as it will be
+        once this run is done: the ported line or, with --output (where the
+        template itself is left alone), the original line.
+
+        Returns the path of the temporary file, or None if no line changed.
+
+        """
+        temp_file = temp_path = None
+        unchanged_bytes = 0
+        unchanged_lines = []
+        in_place = not self.options.output_path
+
+        try:
+            for line, ported_line in pairs:
+                if digest is not None:
+                    digest.update(ported_line if in_place else line)
+
+                if temp_file is None:
+                    if ported_line == line:
+                        if in_memory:
+                            unchanged_lines.append(line)
+                        else:
+                            unchanged_bytes += len(line)
+                        continue
+
+                    dirname, basename = os.path.split(self.destination(template_path))
+                    self.make_dirs(dirname)
+                    fd, temp_path = mkstemp(prefix='.%s.' % basename, dir=dirname or '.')
+                    temp_file = os.fdopen(fd, 'wb', 65536)
+                    temp_file.writelines(unchanged_lines)
+                    if unchanged_bytes:
+                        with open(template_path, 'rb') as template:
+                            while unchanged_bytes:
+                                chunk = template.read(min(unchanged_bytes, 65536))
+                                if not chunk:
+                                    break
+                                temp_file.write(chunk)
+                                unchanged_bytes -= len(chunk)
+
+                temp_file.write(ported_line)
+
+            if temp_file is not None:
+                temp_file.close()
+        except:
+            if temp_file is not None:
+                temp_file.close()
+                os.remove(temp_path)
+            raise
+
+        return temp_path
+
+
+    def replace_template(self, template_path, temp_path):
+        """
+        Rename the ported version of a template over the original (or into
+        place in the --output directory).
+
+        The template is therefore never left half-written, and anything
+        reading it sees either the old version or the new one.
+
+        """
+        destination = self.destination(template_path)
+        try:
+            # mkstemp creates the file readable only by us.
+            os.chmod(temp_path, S_IMODE(os.stat(template_path).st_mode))
+            # Windows won't rename over an existing file.
+            if os.name == 'nt' and os.path.exists(destination):
+                os.remove(destination)
+            os.rename(temp_path, destination)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def mirror_template_roots(self, output_path):
+        """
+        Return where each of the template roots is mirrored in the --output directory.
+
+        Each root is mirrored in a directory (or file) of the same name
+        within the output directory, with a number added to any name that
+        is already taken by an earlier root.
+
+        No mirror may be, contain or be inside any of the template roots,
+        or templates would be written over or ported twice.
+
+        """
+        output_path = os.path.abspath(output_path)
+        output_roots = []
+        for template_root in self.template_roots:
+            name = os.path.basename(os.path.abspath(template_root))
+            output_root = os.path.join(output_path, name)
+            i = 1
+            while output_root in output_roots:
+                i += 1
+                output_root = os.path.join(output_path, '%s-%d' % (name, i))
+            output_roots.append(output_root)
+
+        for output_root in output_roots:
+            for template_root in self.template_roots:
+                if self._overlaps(output_root, template_root):
+                    raise PortError(u"The --output directory would mirror %s over (or within) the template directory %s." % (output_root, template_root))
+        return output_roots
+
+
+    def _overlaps(self, path, other_path):
+        """Return whether two paths are the same, or either is inside the other."""
+        path = os.path.join(os.path.realpath(path), '')
+        other_path = os.path.join(os.path.realpath(other_path), '')
+        return path.startswith(other_path) or other_path.startswith(path)
+
+
+    def destination(self, template_path):
+        """
+        Return where the ported version of a template goes.
+
+        With --output, templates outside all of the template roots have
+        nowhere to go, and raise ValueError.
+
+        """
+        if not self.options.output_path:
+            return template_path
+
+        path = os.path.abspath(template_path)
+        # Templates may be ported without ever being looked for (see
+        # port_files and serve).
+        if self.output_roots is None:
+            if not self.template_roots:
+                self.template_roots = self.find_template_roots(self.config_paths)
+            self.output_roots = self.mirror_template_roots(self.options.output_path)
+
+        for template_root, output_root in zip(self.template_roots, self.output_roots):
+            template_root = os.path.abspath(template_root)
+            if path == template_root:
+                return output_root
+            template_root = os.path.join(template_root, '')
+            if path.startswith(template_root):
+                return os.path.join(output_root, path[len(template_root):])
+        raise ValueError("%s is not in any of the template directories, so has no place in the --output directory." % template_path)
+
+
+    def make_dirs(self, path):
+        """Create a directory (and any parents) unless it already exists."""
+        if path and not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                # Another thread or process may have just created it.
+                if e.errno != errno.EEXIST:
+                    raise
+
+
+    def link_template(self, template_path):
+        """
+        Put a template that needs no porting in the --output directory.
+
+        Rather than being read and written out again, the template is hard
+        linked into place, which costs next to nothing. It is only copied
+        if that isn't possible (e.g. the output directory is on another
+        filesystem). Note that a hard link is the very same file as the
+        template, so changing either one in place changes both.
+
+        """
+        self.link_file(template_path)
+        if self.stats is not None:
+            self.stats.counters['linked'] += 1
+
+
+    def link_file(self, path):
+        """Hard link (or copy) a file into its place in the --output directory. See link_template."""
+        destination = self.destination(path)
+        self.make_dirs(os.path.dirname(destination))
+        if os.path.lexists(destination):
+            if os.path.exists(destination) and os.path.samefile(path, destination):
+                return
+            os.remove(destination)
+
+        try:
+            # Link to the file itself, rather than to any link to it.
+            os.link(os.path.realpath(path), destination)
+        except (AttributeError, OSError):
+            # Windows has no os.link in Python 2.
+            shutil.copy2(path, destination)
+
+
+    def mirror_file(self, path):
+        """Put a file that isn't a template in the --output directory, noting any failure."""
+        try:
+            self.link_file(path)
+        except (IOError, OSError), e:
+            self.mirror_errors.append((path, e.strerror or str(e)))
+
+
+    def fingerprint(self):
+        """
+        Return a digest of everything that affects how templates are ported.
+
+        A manifest is only trusted if it was written by a run with the same
+        fingerprint, so changing config.yml, the installed models, the
+        requested changes or this program itself means every template is
+        ported again.
+
+        """
+        fingerprint = sha1(SOURCE_DIGEST)
+        for value in (sorted(self.extensions),
+                      sorted(self.related_names.items()),
+                      sorted(self.ignored_methods),
+                      self.options.add_extension,
+                      self.options.update_file_fields,
+                      self.options.update_relations,
+                      self.options.tags_only,
+                      self.options.output_path and os.path.abspath(self.options.output_path),
+                      self.options.dependencies_path and os.path.abspath(self.options.dependencies_path)):
+            fingerprint.update(repr(value))
+        return fingerprint.hexdigest()
+
+
+    def load_manifest(self):
+        """
+        Load the manifest written by the last incremental run.
+
+        The manifest maps the absolute path of each template to its size,
+        modification time and SHA-1 digest as they were when the last run
+        finished with it. An empty manifest is returned if there is none,
+        or if it was written with a different fingerprint.
+
+        """
+        fingerprint = self.fingerprint()
+        try:
+            with open(self.options.manifest_path, 'rb') as manifest_file:
+                manifest = pickle.load(manifest_file)
+        except Exception:
+            # E.g. a manifest written by another version of this program.
+            manifest = None
+
+        if not isinstance(manifest, dict) or manifest.get('fingerprint') != fingerprint:
+            manifest = {'fingerprint': fingerprint, 'templates': {}}
+        return manifest
+
+
+    def save_manifest(self, manifest):
+        """Write the manifest for the next incremental run."""
+        self.save_pickle(manifest, self.options.manifest_path)
+
+
+    def save_pickle(self, value, path):
+        """
+        Pickle a value to a file, by way of a temporary file.
+
+        The temporary file is only renamed into place once it is complete,
+        so an interrupted run can't leave a half-written file behind. Each
+        run gets a temporary file of its own, so runs saving the same file
+        at the same time (e.g. on several CI workers) can't clash either.
+
+        """
+        dirname, basename = os.path.split(path)
+        fd, temp_path = mkstemp(prefix='.%s.' % basename, dir=dirname or '.')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                pickle.dump(value, temp_file, pickle.HIGHEST_PROTOCOL)
+            # mkstemp creates the file readable only by us.
+            if os.path.exists(path):
+                os.chmod(temp_path, S_IMODE(os.stat(path).st_mode))
+            else:
+                os.chmod(temp_path, 0644)
+            # Windows won't rename over an existing file.
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def incremental_tasks(self, manifest, unchanged):
+        """
+        Generate (template_path, previous) pairs for port_template.
+
+        Templates whose size and modification time match their manifest
+        entry are appended to ``unchanged`` instead. With --output, they
+        are only skipped if their ported version is still there.
+
+        """
+        for template_path in self.template_paths:
+            previous = manifest['templates'].get(os.path.abspath(template_path))
+            if previous is not None and self.options.output_path and \
+               not os.path.exists(self.destination(template_path)):
+                previous = None
+            if previous is not None:
+                try:
+                    stat = os.stat(template_path)
+                except OSError:
+                    # Let port_template report the problem.
+                    stat = None
+                if stat is not None and (stat.st_size, stat.st_mtime) == previous[:2]:
+                    unchanged.append(template_path)
+                    continue
+            yield template_path, previous
+
+
+    def contents_digest(self, path, contents=None):
+        """Return the SHA-1 digest of a file's contents, reading them if they aren't given."""
+        if contents is None:
+            return self.file_digest(path)
+        return sha1(contents).hexdigest()
+
+
+    def file_digest(self, path):
+        """Return the SHA-1 digest of a file's contents."""
+        digest = sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+    def manifest_entry(self, template_path, digest):
+        """Return the manifest entry for a template as it is now."""
+        stat = os.stat(template_path)
+        return (stat.st_size, stat.st_mtime, digest)
 
 
     def load_config(self):
@@ -122,12 +1536,11 @@ class TemplateMonkey(object):
 
         Loads the specified YAML configuration file and adds all
         methods found on any model in settings.INSTALLED_APPS to
-        the ignored_methods list, and then removes any methods
-        in force_update from ignored_methods.
+        the ignored_methods list (unless --no-model-scan was given),
+        and then removes any methods in force_update from
+        ignored_methods.
 
         """
-        from django.db import models
-
         # Q: Should I be using a try/except block or while?
         # Q: If with is used, how do I handle exceptions in a with statement?
         # Q: What if config_file is moved/altered while after being opened,
@@ -139,8 +1552,11 @@ class TemplateMonkey(object):
         #     sys.exit()
         # config = yaml.load(config_file)
         # config_file.close()
-        with open(options.config_path) as config_file:
+        start = time()
+        with open(self.options.config_path) as config_file:
             config = yaml.load(config_file)
+        if self.stats is not None:
+            self.stats.timings['load_config'] += time() - start
 
         # Append all get_* methods from all models to the list
         # of methods that will always be left untouched.
@@ -148,10 +1564,17 @@ class TemplateMonkey(object):
         # Q: If the YAML syntax is wrong we will get a confusing
         #    error message here. Should we handle that exception?
         config['ignored_methods'] = set(config['ignored_methods'])
-        for model in models.get_models():
-            for func_name, func in model.__dict__.items():
-                if func_name.startswith('get_'):
-                    config['ignored_methods'].add(func_name)
+        if not self.options.no_model_scan:
+            start = time()
+            self.load_settings()
+            from django.db import models
+
+            for model in models.get_models():
+                for func_name, func in model.__dict__.items():
+                    if func_name.startswith('get_'):
+                        config['ignored_methods'].add(func_name)
+            if self.stats is not None:
+                self.stats.timings['model_scan'] += time() - start
 
         # Now remove methods from the ignored_methods list that
         # are to be updated despite being actual methods.
@@ -164,52 +1587,363 @@ class TemplateMonkey(object):
         # Remove this key as it’s no longer needed. (This may be overkill.)
         del config['force_update']
 
-        # This is the place to do this, but the execution looks a little
-        # wonky. Maybe there is a more graceful way to do this?
-        config['template_paths'] = self.create_template_paths(config['template_paths'])
-
         return config
 
 
     def create_template_paths(self, config_paths):
         """
-        Generate a complete list of templates to be worked on.
+        Generate the templates to be worked on.
 
         This is done using one of the following, in this order:
 
         1. The arguments passed to any --template-path options,
-        2. The directories in in TEMPLATE DIRS of the settings
+        2. The paths in config.template_paths,
+        3. The directories in in TEMPLATE DIRS of the settings
            module (supplied by the --settings option or the
            DJANGO_SETTINGS_MODULE environment variable).
 
+        Directories are scanned for templates by find_templates, all of
+        them at once, and templates are handed out as soon as they are
+        found rather than once every directory has been scanned. They are
+        still handed out in a predictable order: everything from the first
+        directory, then everything from the second, and so on.
+
         """
-        template_paths = []
+        template_roots = self.find_template_roots(config_paths)
+        if not template_roots:
+            raise PortError(u"You either failed to provide any template paths (via the --template-path option, config.template_paths, or settings.TEMPLATE_DIRS), or those you specified do not exist.")
+        self.template_roots = template_roots
+
+        return self.discover_templates(template_roots)
+
+
+    def find_template_roots(self, config_paths):
+        """Return whichever of the template roots (see create_template_paths) exist."""
+        template_roots = []
+        for path in self.options.template_paths or config_paths or self.load_settings().TEMPLATE_DIRS:
+            if os.path.exists(path):
+                template_roots.append(path)
+        return template_roots
+
+
+    def discover_templates(self, template_roots):
+        """Scan each of the template roots in its own thread. See create_template_paths."""
+        queues = []
+        for template_root in template_roots:
+            queue = Queue()
+            thread = Thread(target=self._queue_templates, args=(template_root, queue, self.stats))
+            thread.setDaemon(True)
+            thread.start()
+            queues.append(queue)
+
+        # Roots may overlap, and with --follow-symlinks a template may be
+        # reachable by more than one route. With --output, though, each
+        # route has a place of its own in the output directory.
+        if self.options.follow_symlinks and not self.options.output_path:
+            canonical_path = os.path.realpath
+        else:
+            canonical_path = os.path.abspath
+        seen = set()
+        for queue in queues:
+            for template_path in iter(queue.get, None):
+                key = canonical_path(template_path)
+                if key not in seen:
+                    seen.add(key)
+                    yield template_path
+
+
+    def _queue_templates(self, template_root, queue, stats):
+        start = time()
+        try:
+            for template_path in self.find_templates(template_root):
+                queue.put(template_path)
+        finally:
+            if stats is not None:
+                stats.timings['discovery'] += time() - start
+            queue.put(None)
 
-        for path in options.template_paths or config_paths or self.settings.TEMPLATE_DIRS:
-            # Generally directories will be given to us.
-            if os.path.isdir(path):
-                for dirpath, dirnames, filenames in os.walk(path):
-                    # Note that items must be removed from dirnames “in place” — which
-                    # means we can’t just do a dirnames.remove(dirname) in the first
-                    # loop. We have to generate the list and then remove them.
-                    dot_dirnames = []
-                    for dirname in dirnames:
-                        if dirname.startswith('.'):
-                            dot_dirnames.append(dirname)
-                    for dirname in dot_dirnames:
-                        dirnames.remove(dirname)
-                    for filename in filenames:
-                        if not filename.startswith('.'):
-                            template_paths.append(os.path.join(dirpath, filename))
-
-            # But occasionally someone might hand us a single template file.
-            elif os.path.isfile(path):
-                template_paths.append(path)
-
-        if not template_paths:
-            print u"You either failed to provide any template paths (via the --template-path option, config.template_paths, or settings.TEMPLATE_DIRS), or those you specified do not exist."
-            sys.exit()
-        return template_paths
+
+    def find_templates(self, template_root):
+        """
+        Generate the templates under a single template root.
+
+        Generally directories will be given to us, but occasionally
+        someone might hand us a single template file, which is always used.
+
+        Within directories, dot files and directories are skipped, as is
+        anything matching an --exclude pattern. Files are only used if they
+        end with one of config.extensions or, if any --include patterns were
+        given, if they match one of those instead. Patterns are matched
+        against the path relative to the template root.
+
+        Symbolic links are skipped unless --follow-symlinks is given, in
+        which case linked files are ported in place (rather than replacing
+        the link) and linked directories are scanned, though never twice,
+        so links back up the tree do not cause a loop. With --output, the
+        link itself is given instead, as that is where the ported template
+        goes in the output directory.
+
+        So that the output directory is a complete copy, any other files in
+        the directories scanned (including dot files and excluded files, but
+        not the contents of dot or excluded directories) are hard linked
+        into the output directory as they are found.
+
+        """
+        follow_symlinks = self.options.follow_symlinks
+        # Linked files are given by the path of the file itself, unless
+        # they are only to be read.
+        if self.options.output_path:
+            resolve = lambda path: path
+        else:
+            resolve = os.path.realpath
+        mirror_files = self.options.output_path and not self.options.dry_run
+
+        if not os.path.isdir(template_root):
+            yield resolve(template_root) if os.path.islink(template_root) else template_root
+            return
+
+        visited = set()
+        stack = [template_root]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                if follow_symlinks:
+                    stat = os.stat(dirpath)
+                    if (stat.st_dev, stat.st_ino) in visited:
+                        continue
+                    visited.add((stat.st_dev, stat.st_ino))
+                names = os.listdir(dirpath)
+            except OSError:
+                continue
+
+            dirnames = []
+            for name in sorted(names):
+                path = os.path.join(dirpath, name)
+                relative_path = path[len(template_root):].lstrip(os.sep).replace(os.sep, '/')
+                skipped = name.startswith('.') or \
+                          self.options.exclude and self._matches(relative_path, self.options.exclude)
+                if skipped and not mirror_files:
+                    continue
+                if os.path.islink(path):
+                    if not follow_symlinks:
+                        continue
+                    is_link = True
+                else:
+                    is_link = False
+
+                if os.path.isdir(path):
+                    if not skipped:
+                        dirnames.append(path)
+                elif not skipped and (self.options.include and self._matches(relative_path, self.options.include) or
+                                      not self.options.include and name.endswith(self.extension_suffixes)):
+                    yield resolve(path) if is_link else path
+                elif mirror_files:
+                    self.mirror_file(path)
+
+            # Scan subdirectories in order, after this directory's files.
+            dirnames.reverse()
+            stack.extend(dirnames)
+
+
+    def _matches(self, path, patterns):
+        for pattern in patterns:
+            if fnmatch(path, pattern):
+                return True
+        return False
+
+
+    def rewrite_line(self, line, add_extension=False, update_file_fields=False, update_relations=False, tags_only=False):
+        """
+        Apply any of the requested changes to a line in a single pass.
+
+        Every {% extends %}/{% include %} tag and every get_* reference is
+        found with one scan of the line, and each is then handed to
+        add_extension or rewrite_reference as needed. This gives the same
+        results as running add_extension, update_file_fields and
+        update_relations in turn, but without rescanning the line for
+        each of them.
+
+        Note that template names in {% extends %} and {% include %} tags
+        are never treated as get_* references.
+
+        If ``tags_only`` is given, the line is first split into literal text
+        and tags, using the same delimiters as Django's own lexer, and only
+        {% %} and {{ }} tags are rewritten. Literal text (such as inline
+        JavaScript) and {# #} comments are left as they are.
+
+        """
+        if not add_extension and not update_file_fields and not update_relations:
+            return line
+
+        stats = self.stats
+
+        def replace(match):
+            replacement = match.group(0)
+
+            if match.group('tag_match'):
+                if add_extension:
+                    if stats is not None:
+                        start = time()
+                    name = match.group('file_path')
+                    if not name.endswith(self.extension_suffixes):
+                        # Note that we are fixing quotes as we go, just to be nice.
+                        # Single quotes ('') will be replaced with double quotes ("").
+                        replacement = '{%% %s "%s.html" %%}' % (match.group('tag'), name)
+                        name = '%s.html' % name
+                    if self.dependencies is not None:
+                        self.dependencies.append((match.group('tag'), name))
+                    if stats is not None:
+                        stats.timings['add_extension'] += time() - start
+
+            elif update_file_fields or update_relations:
+                # The character following the reference matters for get_foo,
+                # but it must not be consumed as it may begin another match.
+                end = match.end()
+                replacement = match.group('prepend_char') + self.rewrite_reference(match.group('reference'),
+                                                                                   match.string[end:end + 1],
+                                                                                   update_file_fields,
+                                                                                   update_relations)
+
+            if stats is not None:
+                stats.counters['matches'] += 1
+                if replacement != match.group(0):
+                    stats.counters['substitutions'] += 1
+            return replacement
+
+        if not tags_only:
+            return self.rewrite_regex.sub(replace, line)
+
+        # Most lines of most templates have no tags at all.
+        if BLOCK_TAG_START not in line and VARIABLE_TAG_START not in line:
+            return line
+
+        # Splitting on a regex with a group leaves the tags at odd indexes.
+        bits = self.tag_regex.split(line)
+        for i in range(1, len(bits), 2):
+            if not bits[i].startswith(COMMENT_TAG_START):
+                bits[i] = self.rewrite_regex.sub(replace, bits[i])
+        return ''.join(bits)
+
+
+    def rewrite_reference(self, reference, following_char='', update_file_fields=False, update_relations=False):
+        """
+        Return the replacement for a single get_* reference.
+
+        ``following_char`` is the character immediately after the reference
+        in the template, if any. See update_file_fields and update_relations
+        for the replacements made.
+
+        The same references turn up over and over again, so the replacement
+        for each is only worked out the first time it is seen.
+
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time()
+
+        # Only whether the following character is whitespace, a dot or
+        # something else makes any difference to the replacement.
+        if following_char.isspace():
+            following_char = ' '
+        elif following_char != '.':
+            following_char = ''
+
+        key = (reference, following_char, update_file_fields, update_relations)
+        decision = self.decisions.get(key)
+        if decision is None:
+            decision = self.decide_reference(reference, following_char, update_file_fields, update_relations)
+            if len(self.decisions) < self.decision_cache_size:
+                self.decisions[key] = decision
+        elif stats is not None:
+            stats.counters['decision_cache_hits'] += 1
+            stats.counters['ignored_methods_hits'] += decision[1]
+            stats.counters['related_names_hits'] += decision[2]
+
+        if self.decision_counts is not None:
+            self.decision_counts[reference, decision[0]] += 1
+        if stats is not None:
+            stats.timings['references'] += time() - start
+        return decision[0]
+
+
+    def decide_reference(self, reference, following_char, update_file_fields, update_relations):
+        """
+        Work out the replacement for a get_* reference (see rewrite_reference).
+
+        Returns the replacement, along with the number of ignored_methods
+        and related_names entries that it hit.
+
+        """
+        stats = self.stats
+        ignored_methods_hits = related_names_hits = 0
+
+        # Give the regexen the reference as they would find it in a line.
+        reference = '.%s%s' % (reference, following_char)
+
+        if update_file_fields:
+            if stats is not None:
+                start = time()
+
+            match = self.file_field_regex.search(reference)
+
+            if match:
+                if match.group('full_match') in self.ignored_methods:
+                    ignored_methods_hits += 1
+                else:
+                    reference = self.file_field_regex.sub('\g<prepend_char>\g<field>.\g<method>', reference)
+
+            if stats is not None:
+                stats.timings['decide_file_fields'] += time() - start
+
+        if update_relations:
+            if stats is not None:
+                start = time()
+
+            count_match = self.rel_count_regex.search(reference)
+
+            if count_match:
+                related_name = self.related_names.get(count_match.group('full_match'))
+                if related_name:
+                    reference = self.rel_count_regex.sub('\g<prepend_char>%s' % related_name, reference)
+                    related_names_hits += 1
+                elif count_match.group('full_match') in self.ignored_methods:
+                    ignored_methods_hits += 1
+                else:
+                    reference = self.rel_count_regex.sub('\g<prepend_char>\g<field>.count', reference)
+
+            list_match = self.rel_list_regex.search(reference)
+
+            if list_match:
+                related_name = self.related_names.get(list_match.group('full_match'))
+                if related_name:
+                    reference = self.rel_list_regex.sub('\g<prepend_char>%s' % related_name, reference)
+                    related_names_hits += 1
+                elif list_match.group('full_match') in self.ignored_methods:
+                    ignored_methods_hits += 1
+                else:
+                    reference = self.rel_list_regex.sub('\g<prepend_char>\g<field>.all', reference)
+
+            # Do the basic check last.
+            basic_match = self.rel_basic_regex.search(reference)
+
+            if basic_match:
+                if basic_match.group('full_match') in self.ignored_methods:
+                    ignored_methods_hits += 1
+                elif self.file_method_regex.match(basic_match.group('full_match')):
+                    # E.g. get_photo_url is a file field's method (see
+                    # update_file_fields), not a relation.
+                    pass
+                else:
+                    reference = self.rel_basic_regex.sub('\g<prepend_char>\g<field>\g<following_char>', reference)
+
+            if stats is not None:
+                stats.timings['decide_relations'] += time() - start
+
+        if stats is not None:
+            stats.counters['ignored_methods_hits'] += ignored_methods_hits
+            stats.counters['related_names_hits'] += related_names_hits
+
+        return reference[1:len(reference) - len(following_char)], ignored_methods_hits, related_names_hits
 
 
     def add_extension(self, line):
@@ -231,16 +1965,7 @@ class TemplateMonkey(object):
         listed in config.extensions will be skipped.
 
         """
-        match = self.extension_regex.search(line)
-
-        if match:
-            # Make sure the extension isn't already present.
-            if not self.extension_present_regex.search(line):
-                # Note that we are fixing quotes as we go, just to be nice.
-                # Single quotes ('') will be replaced with double quotes ("").
-                line = self.extension_regex.sub('{% \g<tag> "\g<file_path>.html" %}', line)
-
-        return line
+        return self.rewrite_line(line, add_extension=True)
 
 
     def update_file_fields(self, line):
@@ -267,13 +1992,7 @@ class TemplateMonkey(object):
            removed methods listed in force_update from ignored_methods).
 
         """
-        match = self.file_field_regex.search(line)
-
-        if match:
-            if not match.group('full_match') in self.ignored_methods:
-                line = self.file_field_regex.sub('\g<prepend_char>\g<field>.\g<method>', line)
-
-        return line
+        return self.rewrite_line(line, update_file_fields=True)
 
 
     def update_relations(self, line):
@@ -300,32 +2019,7 @@ class TemplateMonkey(object):
         to account for related_name attributes via related_names.
 
         """
-        count_match = self.rel_count_regex.search(line)
-
-        if count_match:
-            if count_match.group('full_match') in self.related_names:
-                line = self.rel_count_regex.sub('\g<prepend_char>%s.count' % self.related_names[count_match.group('full_match')], line)
-            elif not count_match.group('full_match') in self.ignored_methods:
-                line = self.rel_count_regex.sub('\g<prepend_char>\g<field>.count', line)
-
-        list_match = self.rel_list_regex.search(line)
-        
-        if list_match:
-            if list_match.group('full_match') in self.related_names:
-                line = self.rel_list_regex.sub('\g<prepend_char>%s.count' % self.related_names[list_match.group('full_match')], line)
-            elif not list_match.group('full_match') in self.ignored_methods:
-                line = self.rel_list_regex.sub('\g<prepend_char>\g<field>.all', line)
-
-        # Do the basic check last.
-        basic_match = self.rel_basic_regex.search(line)
-
-        if basic_match:
-            if basic_match.group('full_match') in self.related_names:
-                line = self.rel_basic_regex.sub('\g<prepend_char>%s.count' % self.related_names[basic_match.group('full_match')], line)
-            elif not basic_match.group('full_match') in self.ignored_methods:
-                line = self.rel_basic_regex.sub('\g<prepend_char>\g<field>\g<following_char>', line)
-
-        return line
+        return self.rewrite_line(line, update_relations=True)
 
 
 class ReplacementTestCase(unittest.TestCase):
@@ -375,7 +2069,32 @@ class ReplacementTestCase(unittest.TestCase):
 
         # Mock.
         TemplateMonkey.create_template_paths = lambda self, x: []
-        self.monkey = TemplateMonkey()
+        self.monkey = TemplateMonkey(options)
+        self.temp_paths = []
+
+    def tearDown(self):
+        for path in self.temp_paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def temp_file(self, contents=None):
+        """Return the path of a temporary file holding ``contents`` (or of no file yet, if None)."""
+        fd, path = mkstemp()
+        if contents is not None:
+            os.write(fd, contents)
+        os.close(fd)
+        if contents is None:
+            os.remove(path)
+        self.temp_paths.append(path)
+        return path
+
+    def temp_dir(self):
+        """Return the path of an empty temporary directory."""
+        path = mkdtemp()
+        self.temp_paths.append(path)
+        return path
 
     def test_extensions(self):
         if not options.add_extension:
@@ -404,8 +2123,269 @@ class ReplacementTestCase(unittest.TestCase):
         for old_template, new_template in self.sample_relations_templates.items():
             self.assertEqual(self.monkey.update_relations(old_template), new_template)
 
+    def test_combined(self):
+        # Each tag and reference is considered on its own, not just the
+        # first one found on the line.
+        samples = {
+            '{% extends "foo.html" %}{% include \'bar\' %}': '{% extends "foo.html" %}{% include "bar.html" %}',
+            '{{ model.get_photo_url }} {{ model.get_absolute_url }}': '{{ model.photo.url }} {{ model.get_absolute_url }}',
+            '{% include "get_foo_url" %}{{ model.get_myfield.get_photo_url }}': '{% include "get_foo_url.html" %}{{ model.myfield.photo.url }}',
+        }
 
-if __name__ == '__main__':
+        for old_template, new_template in samples.items():
+            self.assertEqual(self.monkey.rewrite_line(old_template, True, True, True), new_template)
+
+    def test_tags_only(self):
+        samples = {
+            '<script>var url = photo.get_image_url;</script>{{ model.get_photo_url }}': '<script>var url = photo.get_image_url;</script>{{ model.photo.url }}',
+            '{# model.get_photo_url #}{% include \'bar\' %} bar.get_baz ': '{# model.get_photo_url #}{% include "bar.html" %} bar.get_baz ',
+            '{% if model.get_myfield %}{{ model.get_myfield.name }}{% endif %}': '{% if model.myfield %}{{ model.myfield.name }}{% endif %}',
+        }
+
+        for old_template, new_template in samples.items():
+            self.assertEqual(self.monkey.rewrite_line(old_template, True, True, True, True), new_template)
+
+    def test_fingerprint(self):
+        fingerprint = self.monkey.fingerprint()
+        self.assertEqual(self.monkey.fingerprint(), fingerprint)
+
+        self.monkey.extensions = self.monkey.extensions + ['htm']
+        self.assertNotEqual(self.monkey.fingerprint(), fingerprint)
+
+    def test_diff_template(self):
+        original = ['a\n', 'b\n', '{{ model.get_photo_url }}', ]
+        ported = ['a\n', 'b\n', '{{ model.photo.url }}', ]
+        self.assertEqual(self.monkey.diff_template('foo.html', original, original), None)
+        self.assertEqual(self.monkey.diff_template('foo.html', original, ported),
+                         '--- a/foo.html\n+++ b/foo.html\n@@ -1,3 +1,3 @@\n a\n b\n'
+                         '-{{ model.get_photo_url }}\n\\ No newline at end of file\n'
+                         '+{{ model.photo.url }}\n\\ No newline at end of file\n')
+
+    def test_write_template(self):
+        template_path = self.temp_file('one\ntwo\nthree')
+
+        unchanged = [('one\n', 'one\n'), ('two\n', 'two\n'), ('three', 'three')]
+        self.assertEqual(self.monkey.write_template(template_path, iter(unchanged)), None)
+
+        changed = [('one\n', 'one\n'), ('two\n', '2\n'), ('three', 'three')]
+        temp_path = self.monkey.write_template(template_path, iter(changed))
+        self.monkey.replace_template(template_path, temp_path)
+        self.assertEqual(open(template_path).read(), 'one\n2\nthree')
+
+        # Lines already held in memory aren't read from the template again.
+        temp_path = self.monkey.write_template(template_path, changed, in_memory=True)
+        self.monkey.replace_template(template_path, temp_path)
+        self.assertEqual(open(template_path).read(), 'one\n2\nthree')
+
+    def test_decisions(self):
+        if not options.update_file_fields or not options.update_relations:
+            return
+
+        line = '{{ model.get_photo_url }} {{ model.get_absolute_url }} {{ model.get_photo_url }}'
+        self.assertEqual(self.monkey.rewrite_line(line, False, True, True),
+                         '{{ model.photo.url }} {{ model.get_absolute_url }} {{ model.photo.url }}')
+        self.assertEqual(self.monkey.decisions[('get_photo_url', ' ', True, True)][0], 'photo.url')
+        self.assertEqual(self.monkey.decisions[('get_absolute_url', ' ', True, True)][0], 'get_absolute_url')
+
+        # A remembered decision is used as is.
+        self.monkey.decisions[('get_photo_url', ' ', True, True)] = ('foo', 0, 0)
+        self.assertEqual(self.monkey.rewrite_line('{{ model.get_photo_url }}', False, True, True),
+                         '{{ model.foo }}')
+
+    def test_dependencies(self):
+        if not options.add_extension:
+            return
+
+        self.monkey.dependencies = []
+        try:
+            self.monkey.rewrite_line('{% extends "base" %}{% include \'foo.html\' %}{% include "foo" %}', True)
+            entry = self.monkey.dependency_entry('foo/bar.html', self.monkey.dependencies)
+        finally:
+            self.monkey.dependencies = None
+        self.assertEqual(entry['extends'], ['base.html'])
+        self.assertEqual(entry['includes'], ['foo.html'])
+
+        self.monkey.template_roots = ['foo']
+        self.assertEqual(self.monkey.template_name('foo/bar/baz.html'), 'bar/baz.html')
+        self.assertEqual(self.monkey.template_name('bar/baz.html'), 'baz.html')
+
+    def test_io_threads(self):
+        io_threads = IOThreads(2)
+        try:
+            jobs = [io_threads.run(pow, i, 2) for i in range(10)]
+            failed = io_threads.run(int, 'foo')
+            self.assertEqual([job.wait() for job in jobs], [i ** 2 for i in range(10)])
+            self.assertRaises(ValueError, failed.wait)
+        finally:
+            io_threads.close()
+
+    def test_port_templates_threaded(self):
+        template_root = self.temp_dir()
+        monkey = TemplateMonkey(create_options(add_extension=True, verbosity=False, io_threads=2,
+                                               settings=options.settings, config_path=options.config_path))
+        template_paths = []
+        for i in range(20):
+            template_path = os.path.join(template_root, '%02d.html' % i)
+            with open(template_path, 'w') as template:
+                if i % 3:
+                    template.write('<p>%d</p>\n{%% include "part%d" %%}\n' % (i, i))
+                else:
+                    template.write('<p>%d</p>\n' % i)
+            template_paths.append(template_path)
+
+        results = list(monkey.port_templates_threaded((path, None) for path in template_paths))
+        self.assertEqual([result['template_path'] for result in results], template_paths)
+        self.assertEqual([result['error'] for result in results], [None] * 20)
+        self.assertEqual([result['changed'] for result in results], [bool(i % 3) for i in range(20)])
+        for i, template_path in enumerate(template_paths):
+            with open(template_path) as template:
+                if i % 3:
+                    self.assertEqual(template.read(), '<p>%d</p>\n{%% include "part%d.html" %%}\n' % (i, i))
+                else:
+                    self.assertEqual(template.read(), '<p>%d</p>\n' % i)
+
+    def test_port_templates(self):
+        template_root = self.temp_dir()
+        monkey = TemplateMonkey(create_options(add_extension=True, verbosity=False,
+                                               settings=options.settings, config_path=options.config_path))
+        monkey.create_template_paths = lambda config_paths: monkey.discover_templates([template_root])
+        # Each call looks for the templates again, so a template added
+        # since the first call is ported by the second.
+        for name in ('a.html', 'b.html'):
+            with open(os.path.join(template_root, name), 'w') as template:
+                template.write('{% extends "base" %}\n')
+            monkey.port_templates()
+            with open(os.path.join(template_root, name)) as template:
+                self.assertEqual(template.read(), '{% extends "base.html" %}\n')
+
+    def test_destination(self):
+        output_path = options.output_path
+        self.monkey.template_roots = ['/foo/templates', '/bar/templates', '/bar/base.html']
+        try:
+            options.output_path = '/baz'
+            self.monkey.output_roots = self.monkey.mirror_template_roots(options.output_path)
+            self.assertEqual(self.monkey.destination('/foo/templates/a/b.html'), '/baz/templates/a/b.html')
+            self.assertEqual(self.monkey.destination('/bar/templates/b.html'), '/baz/templates-2/b.html')
+            self.assertEqual(self.monkey.destination('/bar/base.html'), '/baz/base.html')
+        finally:
+            options.output_path = output_path
+        self.assertEqual(self.monkey.destination('/foo/templates/a/b.html'), '/foo/templates/a/b.html')
+
+    def test_mirror_template_roots(self):
+        self.monkey.template_roots = ['/foo/templates', '/bar/templates']
+        # Mirroring the templates onto themselves, into themselves, or
+        # around another template root are all refused.
+        for output_path in ('/foo', '/foo/templates/out', '/bar/templates', '/bar'):
+            self.assertRaises(PortError, self.monkey.mirror_template_roots, output_path)
+        self.assertEqual(self.monkey.mirror_template_roots('/baz'), ['/baz/templates', '/baz/templates-2'])
+
+    def test_port_string(self):
+        if not options.add_extension or not options.update_file_fields:
+            return
+
+        template = '{% extends "base" %}\n{{ model.get_photo_url }}\n'
+        self.assertEqual(self.monkey.port_string(template), '{% extends "base.html" %}\n{{ model.photo.url }}\n')
+        self.assertEqual(self.monkey.port_string(unicode(template)), u'{% extends "base.html" %}\n{{ model.photo.url }}\n')
+
+        if options.update_relations:
+            # A reference at the end of a line is followed by its newline.
+            self.assertEqual(self.monkey.port_string('x.get_foo\ny'), 'x.foo\ny')
+
+        self.monkey.dependencies = []
+        try:
+            self.monkey.port_string(template)
+            self.assertEqual(self.monkey.dependencies, [])
+        finally:
+            self.monkey.dependencies = None
+
+    def test_serve(self):
+        if not options.add_extension:
+            return
+
+        requests = StringIO('{"id": 1, "template": "{% include \'foo\' %}"}\n\n{"foo": "bar"}\nfoo\n')
+        responses = StringIO()
+        self.monkey.serve(requests, responses)
+        responses = [json.loads(response) for response in responses.getvalue().splitlines()]
+        self.assertEqual(responses[0], {'id': 1, 'template': '{% include "foo.html" %}'})
+        self.assertEqual(len(responses), 3)
+        self.assertTrue(responses[1]['error'] and responses[2]['error'])
+
+    def test_classify_template(self):
+        if not options.add_extension or not options.update_file_fields or not options.update_relations:
+            return
+
+        samples = {
+            '': (),
+            '<p>Nothing to see here.</p>\n': (),
+            '{% include "foo.html" %}\n': (True, False, False),
+            '{{ model.get_photo_url }}\n': (False, True, True),
+        }
+
+        for contents, transforms in samples.items():
+            self.assertEqual(self.monkey.classify_template(self.temp_file(contents)), transforms)
+
+    def test_context(self):
+        context_path = self.temp_file()
+        original_context_path, options.context_path = options.context_path, context_path
+        no_model_scan = options.no_model_scan
+        try:
+            # The first monkey builds and saves the context...
+            TemplateMonkey(options)
+            # ...and the next one just loads it.
+            monkey = TemplateMonkey(options)
+            self.assertTrue(monkey.load_context())
+            self.assertEqual(monkey.ignored_methods, self.monkey.ignored_methods)
+            self.assertEqual(monkey.rewrite_line('{{ model.get_photo_url }}', True, True, True),
+                             self.monkey.rewrite_line('{{ model.get_photo_url }}', True, True, True))
+
+            # An out of date context can't be rebuilt without the model scan.
+            with open(context_path, 'wb') as context_file:
+                context_file.write('stale')
+            options.no_model_scan = True
+            self.assertRaises(PortError, TemplateMonkey, options)
+        finally:
+            options.no_model_scan = no_model_scan
+            options.context_path = original_context_path
+
+    def test_find_templates(self):
+        template_root = self.temp_dir()
+        for path in ('base.html', 'logo.png', '.hidden.html', 'news/detail.txt', '.svn/base.html'):
+            path = os.path.join(template_root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+        self.assertEqual(list(self.monkey.find_templates(template_root)),
+                         [os.path.join(template_root, 'base.html'),
+                          os.path.join(template_root, 'news', 'detail.txt')])
+
+        # Under --output, the files that aren't templates are put in the
+        # copy as well, though dot directories are still left out.
+        output_path, dry_run = options.output_path, options.dry_run
+        options.output_path, options.dry_run = self.temp_dir(), False
+        self.monkey.template_roots = [template_root]
+        try:
+            self.monkey.output_roots = self.monkey.mirror_template_roots(options.output_path)
+            self.assertEqual(len(list(self.monkey.find_templates(template_root))), 2)
+            output_root = self.monkey.output_roots[0]
+            self.assertTrue(os.path.exists(os.path.join(output_root, 'logo.png')))
+            self.assertTrue(os.path.exists(os.path.join(output_root, '.hidden.html')))
+            self.assertFalse(os.path.exists(os.path.join(output_root, '.svn')))
+            self.assertFalse(os.path.exists(os.path.join(output_root, 'base.html')))
+            self.assertEqual(self.monkey.mirror_errors, [])
+        finally:
+            options.output_path, options.dry_run = output_path, dry_run
+
+    def test_worker_state(self):
+        monkey = pickle.loads(pickle.dumps(self.monkey))
+        self.assertFalse(hasattr(monkey, 'settings'))
+
+        for old_template, new_template in self.sample_file_field_templates.items():
+            self.assertEqual(monkey.update_file_fields(old_template), self.monkey.update_file_fields(old_template))
+
+
+def create_parser():
+    """Return the parser for this program's command line options."""
     usage = """%prog [options]"""
     desc = __doc__
 
@@ -415,10 +2395,31 @@ if __name__ == '__main__':
                                 help=u"output nothing to the console")
     parser.add_option('-v', '--verbose',
                                 dest='verbosity', action='store_true',
-                                help=u"output all information to the console")
+                                help=u"output all information to the console, including each changed template and the --stats report")
+    parser.add_option('--stats',
+                                dest='stats', action='store_true',
+                                help=u"report where the time went, and how many lines, matches and substitutions there were")
+    parser.add_option('--stats-json',
+                                dest='stats_path', action='store', metavar='/path/to/stats.json',
+                                help=u"save the --stats report as JSON")
+    parser.add_option('--slowest',
+                                dest='slowest', action='store', type='int', default=10, metavar='N',
+                                help=u"list the N slowest templates in the --stats report (default to 10)")
+    parser.add_option('--decisions',
+                                dest='decisions_path', action='store', metavar='/path/to/decisions.txt',
+                                help=u"list every distinct get_* reference found, and what it was replaced with, in the given file")
+    parser.add_option('--dependencies',
+                                dest='dependencies_path', action='store', metavar='/path/to/dependencies.json',
+                                help=u"with --add-extension, save an index of which templates extend or include which, and which are missing, as JSON")
+    parser.add_option('-o', '--output',
+                                dest='output_path', action='store', metavar='/path/to/dir',
+                                help=u"leave the templates alone and write the ported templates to a copy of each template directory in the given directory, hard linking any that don’t change, and every other file alongside them")
     parser.add_option('-n', '--dry-run',
                                 dest='dry_run', action='store_true',
                                 help=u"run everything as normal but don’t save any changes")
+    parser.add_option('-p', '--patch-file',
+                                dest='patch_path', action='store', metavar='/path/to/file.patch',
+                                help=u"with --dry-run, write the patch to the given file rather than the console")
     parser.add_option('-x', '--add-extension',
                                 dest='add_extension', action='store_true',
                                 help=u"add extension “.html” to template references in {% extends %} and {% include %} tags")
@@ -434,18 +2435,85 @@ if __name__ == '__main__':
     parser.add_option('-t', '--template-path',
                                 dest='template_paths', action='append', default=[],
                                 help=u"work on the given path (default to settings.TEMPLATE_DIRS)", metavar="/path/to/templates")
+    parser.add_option('--include',
+                                dest='include', action='append', default=[], metavar='PATTERN',
+                                help=u"only port files matching the given pattern, rather than those with one of config.extensions (may be given more than once)")
+    parser.add_option('--exclude',
+                                dest='exclude', action='append', default=[], metavar='PATTERN',
+                                help=u"skip files and directories matching the given pattern (may be given more than once)")
+    parser.add_option('--follow-symlinks',
+                                dest='follow_symlinks', action='store_true',
+                                help=u"port linked templates and scan linked directories, rather than skipping them")
     parser.add_option('-c', '--config-yaml',
                                 dest='config_path', action='store', default='config.yml', metavar='/path/to/file.yml',
                                 help=u"use the specified YAML file for special-case exceptions. (default to config.yml)")
+    parser.add_option('--tags-only',
+                                dest='tags_only', action='store_true',
+                                help=u"only make changes within {% %} and {{ }} tags, leaving all other text (such as inline JavaScript) alone")
+    parser.add_option('-i', '--incremental',
+                                dest='incremental', action='store_true',
+                                help=u"skip templates that have not changed since the last incremental run with the same configuration and options")
+    parser.add_option('-m', '--manifest',
+                                dest='manifest_path', action='store', default='.port-templates-manifest', metavar='/path/to/manifest',
+                                help=u"where --incremental keeps track of ported templates (default to .port-templates-manifest)")
+    parser.add_option('--context',
+                                dest='context_path', action='store', metavar='/path/to/context',
+                                help=u"cache the config and model methods in the given file, and reuse them while the config and models are unchanged")
+    parser.add_option('--no-model-scan',
+                                dest='no_model_scan', action='store_true',
+                                help=u"don’t import any models to find their methods; with --context, the context must already be up to date (or it is an error), and without it only config.ignored_methods are used")
+    parser.add_option('-j', '--jobs',
+                                dest='jobs', action='store', type='int', default=1, metavar='N',
+                                help=u"port templates in N worker processes, or one per CPU if N is 0 (requires Python 2.6)")
+    parser.add_option('--io-threads',
+                                dest='io_threads', action='store', type='int', default=0, metavar='N',
+                                help=u"read and write templates in N threads while porting them, for slow filesystems (not used with --jobs)")
+    parser.add_option('--serve',
+                                dest='serve', action='store_true',
+                                help=u"rather than porting templates, answer JSON requests to port templates from stdin on stdout, one per line")
+    parser.add_option('--socket',
+                                dest='socket_path', action='store', metavar='/path/to/socket',
+                                help=u"like --serve, but answer requests from connections to the given Unix socket")
     parser.add_option('-T', '--run-tests',
                                 dest='run_tests', action='store_true',
                                 help=u"run unit tests for this program")
 
-    (globals()['options'], args) = parser.parse_args()
+    return parser
+
+
+def create_options(**kwargs):
+    """
+    Return options for a TemplateMonkey, as if given on the command line.
+
+    Options not given here have their usual defaults. Options are named
+    after the attribute they are stored in, e.g.::
+
+        monkey = TemplateMonkey(create_options(add_extension=True, template_paths=['templates']))
+
+    """
+    options = create_parser().get_default_values()
+    for name, value in kwargs.items():
+        if not hasattr(options, name):
+            raise TypeError("There is no '%s' option." % name)
+        setattr(options, name, value)
+    return options
+
+
+if __name__ == '__main__':
+    (globals()['options'], args) = create_parser().parse_args()
 
     if options.run_tests:
         suite = unittest.TestLoader().loadTestsFromTestCase(ReplacementTestCase)
         unittest.TextTestRunner(verbosity=2).run(suite)
     else:
-        monkey = TemplateMonkey()
-        monkey.port_templates()
+        try:
+            if options.socket_path:
+                TemplateMonkey(options).serve_socket(options.socket_path)
+            elif options.serve:
+                TemplateMonkey(options).serve(sys.stdin, sys.stdout)
+            else:
+                monkey = TemplateMonkey(options)
+                monkey.port_templates()
+        except PortError, e:
+            print unicode(e).encode(sys.stdout.encoding or 'utf-8', 'replace')
+            sys.exit()